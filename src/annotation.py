@@ -7,102 +7,490 @@ Description:
     Module with functions to iterate over a vcf and annotate them
 """
 
+import asyncio
+import logging
+from collections import OrderedDict
+from itertools import islice
 from typing import Generator
+import httpx
+import numpy as np
+import pysam
+from diskcache import Cache
 from src.models import AnnotatedVariant, Variant
 from pathlib import Path
-from src.vep import make_vep_request, get_genes_for_most_severe_consequence
-from src.config import VEP_REGION_PAYLOAD
+from src.vep import (
+    VEP_REQUEST_ERRORS,
+    is_payload_error,
+    make_cached_vep_request,
+    variant_to_vep_region,
+)
+from src.config import ANNOTATION_CACHE_SIZE, VCF_CHUNK_SIZE
 from cyvcf2 import VCF
 
+logger = logging.getLogger(__name__)
 
-def read_vcf(input_vcf: Path) -> Generator[Variant, None, None]:
+# Suffix of the bgzipped copy prepare_vcf writes next to a plain text VCF
+# Specific to this tool so a .vcf.gz the user put next to the VCF is never mistaken for it
+BGZIPPED_VCF_SUFFIX = ".annot.vcf.gz"
+# Suffix added to the bgzipped VCF for the file that records which version of the plain text VCF it was made from
+SOURCE_SUFFIX = ".source"
+
+# A VCF only has a handful of distinct chromosomes and variant types, so every Variant shares one string object per value
+# instead of cyvcf2 allocating a new string for every record
+_INTERNED_STRINGS: dict[str, str] = {}
+
+# (gene, consequence) of variants annotated by earlier batches, keyed by variant_key
+# Only accessed from the event loop, so no locking is needed
+_ANNOTATION_CACHE: OrderedDict[tuple[str, int, str, str], tuple[str | None, str]] = (
+    OrderedDict()
+)
+
+
+def read_vcf(
+    input_vcf: Path, chunk_size: int = VCF_CHUNK_SIZE
+) -> Generator[Variant, None, None]:
     """
     Iterate through VCF and yield instance(s) of Variant for each variant
+    Records are read in chunks of @chunk_size so per allele arithmetic can be done for the whole chunk at once
 
     Args:
-        input_vcf (Path): Path to the input VCF file
+        input_vcf (Path): Path to the input VCF file. Plain text VCFs are converted once with prepare_vcf
+        chunk_size (int): Number of VCF records to read and convert together
 
     Returns:
         Yield one instance of Variant
     """
-    vcf = VCF(input_vcf)
+    vcf = VCF(prepare_vcf(Path(input_vcf)))
+
+    while records := list(islice(vcf, chunk_size)):
+        yield from parse_vcf_chunk(records)
+
+
+def prepare_vcf(input_vcf: Path) -> Path:
+    """
+    Get the file cyvcf2 should read for @input_vcf
+    cyvcf2 reads bgzipped VCFs and BCFs in larger blocks than plain text VCFs, so a plain text VCF is bgzipped and tabix indexed next to the input the first time it is annotated
+    The bgzipped VCF is named <name>.annot.vcf.gz so it never reuses or overwrites a <name>.vcf.gz that this tool did not write
+    The size and mtime of @input_vcf are recorded next to it in <name>.annot.vcf.gz.source, and it is only reused by later runs while both still match exactly
+
+    Args:
+        input_vcf (Path): Path to the input VCF file
+
+    Returns:
+        Path of the bgzipped <name>.annot.vcf.gz for a plain text .vcf, otherwise @input_vcf (.vcf.gz and .bcf are read directly)
+        Falls back to @input_vcf if the bgzipped VCF cannot be written
+    """
+    if input_vcf.suffix != ".vcf":
+        return input_vcf
+
+    bgzipped_vcf = input_vcf.with_name(f"{input_vcf.stem}{BGZIPPED_VCF_SUFFIX}")
+    source_file = bgzipped_vcf.with_name(f"{bgzipped_vcf.name}{SOURCE_SUFFIX}")
+    # Taken before compressing, so a VCF modified during the conversion does not match next time
+    source = vcf_source(input_vcf)
+    if bgzipped_vcf.exists() and read_source(source_file) == source:
+        return bgzipped_vcf
 
-    for variant in vcf:
-        ao = ensure_tuple(variant.INFO["AO"])
-        af = ensure_tuple(variant.INFO["AF"])
-        # Even if multiple ALT alleles, variant.INFO["TYPE"] gives comma separated string of types instead of tuple
-        variant_type = (
-            variant.INFO["TYPE"].split(",")
-            if "," in variant.INFO["TYPE"]
-            else [variant.INFO["TYPE"]]
+    # Warning so it shows with the default log level, since the conversion can take a while for a large VCF
+    logger.warning(
+        "Converting %s to bgzipped %s, only done once", input_vcf, bgzipped_vcf
+    )
+    # Removed first so an interrupted conversion never leaves the old source next to a new bgzipped VCF
+    source_file.unlink(missing_ok=True)
+    # Compress to a temporary file first so an interrupted conversion is never picked up as a complete one
+    partial_vcf = bgzipped_vcf.with_name(f"{bgzipped_vcf.name}.partial")
+    try:
+        pysam.tabix_compress(str(input_vcf), str(partial_vcf), force=True)
+        partial_vcf.replace(bgzipped_vcf)
+    except OSError as error:
+        logger.warning(
+            "Could not bgzip %s, reading plain text VCF instead: %s", input_vcf, error
         )
+        partial_vcf.unlink(missing_ok=True)
+        return input_vcf
+
+    try:
+        source_file.write_text(source)
+    except OSError as error:
+        # The bgzipped VCF is still complete, it is just converted again next time
+        logger.warning("Could not write %s: %s", source_file, error)
+
+    try:
+        pysam.tabix_index(str(bgzipped_vcf), preset="vcf", force=True)
+    except OSError as error:
+        # The index is only needed for region queries, the bgzipped VCF can still be iterated without it
+        logger.warning("Could not tabix index %s: %s", bgzipped_vcf, error)
+
+    return bgzipped_vcf
+
+
+def vcf_source(input_vcf: Path) -> str:
+    """
+    Identify the contents of a plain text VCF without reading it
+
+    Args:
+        input_vcf (Path): Path to the input VCF file
+
+    Returns:
+        String "<size in bytes> <mtime in nanoseconds>" of @input_vcf
+    """
+    stat = input_vcf.stat()
+    return f"{stat.st_size} {stat.st_mtime_ns}"
+
+
+def read_source(source_file: Path) -> str | None:
+    """
+    Read the vcf_source recorded when a bgzipped VCF was written
+
+    Args:
+        source_file (Path): Path to the <name>.annot.vcf.gz.source file
+
+    Returns:
+        The recorded vcf_source, or None if @source_file does not exist or cannot be read
+    """
+    try:
+        return source_file.read_text()
+    except OSError:
+        return None
+
+
+def parse_vcf_chunk(records: list) -> list[Variant]:
+    """
+    Create instance(s) of Variant for each record in a chunk of VCF records
+
+    Args:
+        records (list[cyvcf2.Variant]): Chunk of records read from the VCF
+
+    Returns:
+        List of instances of Variant, one for each ALT allele of each record in @records, in VCF order
+        ALT alleles without any REF or ALT reads are logged and left out
+    """
+    # One element per ALT allele across all of @records
+    chroms = []
+    positions = []
+    refs = []
+    alts = []
+    depths = []
+    ref_reads_list = []
+    alt_reads_list = []
+    afs = []
+    variant_types = []
+
+    # Bind methods to locals to skip the attribute lookup per allele
+    intern = _INTERNED_STRINGS.setdefault
+    append_chrom = chroms.append
+    append_pos = positions.append
+    append_ref = refs.append
+    append_alt = alts.append
+    append_depth = depths.append
+    append_ref_reads = ref_reads_list.append
+    append_alt_reads = alt_reads_list.append
+    append_af = afs.append
+    append_variant_type = variant_types.append
+
+    for variant in records:
+        # Every access of variant.INFO creates a new object, so bind it once per record
+        info = variant.INFO
+        ao = ensure_tuple(info.get("AO"))
+        af = ensure_tuple(info.get("AF"))
+        depth = info.get("DP")
+        ref_reads = info.get("RO")
+        # Even if multiple ALT alleles, info["TYPE"] gives comma separated string of types instead of tuple
+        # split returns a single element list when there is only one type
+        variant_type = [intern(value, value) for value in info.get("TYPE").split(",")]
+        chrom = intern(variant.CHROM, variant.CHROM)
+        pos = variant.POS
+        ref = variant.REF
+
         for idx, alt in enumerate(variant.ALT):
+            # alt_perc is undefined when no reads support either allele, so there is nothing to annotate
+            # Logged so every allele missing from the output can be traced back to the VCF
+            if ao[idx] + ref_reads == 0:
+                logger.warning(
+                    "Skipping variant %s:%d %s>%s: no reads support the REF or ALT allele",
+                    chrom,
+                    pos,
+                    ref,
+                    alt,
+                )
+                continue
+
             # For multiple ALT alleles, create an annotation for each individual ALT allele
-            yield Variant(
-                chrom=variant.CHROM,
-                pos=variant.POS,
-                ref=variant.REF,
-                alt=alt,
-                depth=variant.INFO["DP"],
-                ref_reads=variant.INFO["RO"],
-                alt_reads=ao[idx],
-                maf=round(min(af[idx], 1 - af[idx]), 2),
-                type=variant_type[idx],
-            )
+            append_chrom(chrom)
+            append_pos(pos)
+            append_ref(ref)
+            append_alt(alt)
+            append_depth(depth)
+            append_ref_reads(ref_reads)
+            append_alt_reads(ao[idx])
+            append_af(af[idx])
+            append_variant_type(variant_type[idx])
+
+    # Minor allele frequency for every allele in one vectorized pass
+    # np.round scales by 100 before rounding, which rounds some halfway values differently from round
+    # so only the minimum is vectorized and round keeps the maf column the same as before
+    af_array = np.fromiter(afs, dtype=np.float64, count=len(afs))
+    mafs = [round(maf, 2) for maf in np.minimum(af_array, 1 - af_array).tolist()]
 
+    return [
+        Variant(
+            chrom=chrom,
+            pos=pos,
+            ref=ref,
+            alt=alt,
+            depth=depth,
+            ref_reads=ref_reads,
+            alt_reads=alt_reads,
+            maf=maf,
+            type=variant_type,
+        )
+        for chrom, pos, ref, alt, depth, ref_reads, alt_reads, maf, variant_type in zip(
+            chroms,
+            positions,
+            refs,
+            alts,
+            depths,
+            ref_reads_list,
+            alt_reads_list,
+            mafs,
+            variant_types,
+        )
+    ]
 
-def build_annotation(variant_data_batch: list[Variant]) -> list[AnnotatedVariant]:
+
+async def build_annotation(
+    client: httpx.AsyncClient,
+    variant_data_batch: list[Variant],
+    cache: Cache | None = None,
+) -> list[AnnotatedVariant]:
     """
     Annotate each individual variant with info from VEP API and some additional stats
+    Waiting on the VEP API happens on the event loop, while building the AnnotatedVariant instances runs in a worker thread
+    so the event loop stays free for the requests of other batches
 
     Args:
+        client (httpx.AsyncClient): Client used to query the VEP API
         variant_data_batch (list[Variant]): All instances of Variant that are to be annotated
+        cache (Cache | None): Persistent cache of annotations. If None, every variant is sent to the VEP API
 
     Returns:
         List of instances of AnnotatedVariant that represents all info related to annotated variants
     """
+    annotations = await fetch_annotations(client, variant_data_batch, cache)
+    return await asyncio.to_thread(finalize_annotation, variant_data_batch, annotations)
+
+
+async def fetch_annotations(
+    client: httpx.AsyncClient,
+    variant_data_batch: list[Variant],
+    cache: Cache | None = None,
+) -> dict[tuple[str, int, str, str], tuple[str | None, str | None]]:
+    """
+    Get (gene, consequence) of every unique variant in a batch from the in-memory cache or the VEP API
+
+    Args:
+        client (httpx.AsyncClient): Client used to query the VEP API
+        variant_data_batch (list[Variant]): All instances of Variant that are to be annotated
+        cache (Cache | None): Persistent cache of annotations. If None, every variant is sent to the VEP API
+
+    Returns:
+        Dictionary of variant_key to (gene, consequence). Both are None for variants that could not be annotated
+    """
+    # (gene, consequence) for every unique variant key in @variant_data_batch
+    annotations = {}
+
+    # Payloads (string for that variant to query API) for unique variants in @variant_data_batch that are not cached yet
+    # Keyed by variant key so the same variant is only sent to the API once
+    variant_payloads = {}
+
+    for variant_data in variant_data_batch:
+        key = variant_key(variant_data)
+        if key in annotations or key in variant_payloads:
+            continue
+
+        cached_annotation = get_cached_annotation(key)
+        if cached_annotation is not None:
+            annotations[key] = cached_annotation
+            continue
+
+        variant_payloads[key] = variant_to_vep_region(variant_data)
+
+    if variant_payloads:
+        annotations_by_payload = await request_vep_data(
+            client, list(variant_payloads.values()), cache
+        )
+
+        for key, variant_payload in variant_payloads.items():
+            annotation = annotations_by_payload.get(variant_payload)
+            if annotation is None:
+                # Variant is still written with empty gene and consequence so no rows go missing from the output
+                # Not cached, so a later batch or run tries the VEP API again
+                annotations[key] = (None, None)
+                continue
+
+            annotations[key] = annotation
+            cache_annotation(key, annotation)
+
+    return annotations
+
+
+def finalize_annotation(
+    variant_data_batch: list[Variant],
+    annotations: dict[tuple[str, int, str, str], tuple[str | None, str | None]],
+) -> list[AnnotatedVariant]:
+    """
+    Create AnnotatedVariant instances from a batch of variants and their annotations
+    Only CPU work, so build_annotation runs it in a worker thread
+
+    Args:
+        variant_data_batch (list[Variant]): All instances of Variant that are to be annotated
+        annotations (dict): (gene, consequence) for every variant_key in @variant_data_batch, from fetch_annotations
+
+    Returns:
+        List of instances of AnnotatedVariant, one to one with @variant_data_batch
+    """
     # Store all instances of AnnotatedVariant
     # Elements correspond one to one with @variant_data_batch
     annotated_variants = []
 
-    # Payloads (string for that variant to query API) for all variants in @variant_data_batch
-    variant_payload_batch = []
+    # Percentage of reads supporting the alternate allele for the whole batch in one vectorized pass
+    # tolist converts back to python floats so they are written to the csv the same way as before
+    batch_size = len(variant_data_batch)
+    alt_reads = np.fromiter(
+        (variant_data.alt_reads for variant_data in variant_data_batch),
+        dtype=np.int64,
+        count=batch_size,
+    )
+    ref_reads = np.fromiter(
+        (variant_data.ref_reads for variant_data in variant_data_batch),
+        dtype=np.int64,
+        count=batch_size,
+    )
+    alt_percs = np.round(alt_reads * 100.0 / (alt_reads + ref_reads), 2).tolist()
 
-    for variant_data in variant_data_batch:
-        variant_payload = VEP_REGION_PAYLOAD.format(
-            chrom=variant_data.chrom,
-            pos=variant_data.pos,
-            ref=variant_data.ref,
-            alt=variant_data.alt,
+    # Iterate through all variants in this batch and create AnnotatedVariant instances, sharing one annotation between duplicates
+    for variant_data, alt_perc in zip(variant_data_batch, alt_percs):
+        # Variants without an annotation are written with empty gene and consequence
+        gene, consequence = annotations.get(variant_key(variant_data), (None, None))
+        annotated_variants.append(
+            AnnotatedVariant.from_variant(
+                variant_data,
+                gene=gene,
+                consequence=consequence,
+                alt_perc=alt_perc,
+            )
         )
-        variant_payload_batch.append(variant_payload)
 
-    # Payload to send to the API
+    return annotated_variants
+
+
+async def request_vep_data(
+    client: httpx.AsyncClient, variant_payloads: list[str], cache: Cache | None
+) -> dict[str, tuple[str | None, str]]:
+    """
+    Get (gene, consequence) from the VEP API for a list of variant payloads
+    If the API rejects the payload or times out reading it after all retries, split @variant_payloads in half and request each half separately, down to single variants
+    Smaller requests often succeed when a large one times out, and a variant the API rejects only fails its own request
+    Any other failure, e.g. the API being unreachable or rate limiting, is raised, since splitting would only multiply the failing requests
+    Variants left out of a successful response are logged and left out of the result as well
+
+    Args:
+        client (httpx.AsyncClient): Client used to query the VEP API
+        variant_payloads (list[str]): Payloads (string for that variant to query API) of the variants to annotate
+        cache (Cache | None): Persistent cache of annotations. If None, every variant is sent to the VEP API
+
+    Returns:
+        Dictionary of variant payload to (gene, consequence). Variants that could not be annotated are not in it
+
+    Raises:
+        One of VEP_REQUEST_ERRORS if the request failed for a reason other than its payload
+    """
     # Payload format retrieved from https://grch37.rest.ensembl.org/documentation/info/vep_region_post
-    payload = {"variants": variant_payload_batch}
-    # TODO: Handle case where vep_data_batch is None
-    vep_data_batch = make_vep_request(payload)
+    payload = {"variants": variant_payloads}
+    try:
+        annotations = await make_cached_vep_request(client, payload, cache)
+    except VEP_REQUEST_ERRORS as error:
+        # A whole batch failing on transport errors means every variant after it would fail too, so the run is aborted
+        if not is_payload_error(error):
+            raise
 
-    # Iterate through all VEP data for this batch and create AnnotatedVariant instances
-    for idx, vep_data in enumerate(vep_data_batch):
-        annotated_variants.append(
-            AnnotatedVariant(
-                # Data from Variant
-                **variant_data_batch[idx].model_dump(),
-                gene=get_genes_for_most_severe_consequence(vep_data),
-                consequence=vep_data["most_severe_consequence"],
-                alt_perc=round(
-                    (variant_data_batch[idx].alt_reads * 100)
-                    / (
-                        variant_data_batch[idx].alt_reads
-                        + variant_data_batch[idx].ref_reads
-                    ),
-                    2,
-                ),
+        if len(variant_payloads) == 1:
+            logger.warning(
+                "Could not annotate variant '%s' with the VEP API: %s",
+                variant_payloads[0],
+                error,
             )
+            return {}
+
+        logger.warning(
+            "VEP request for %d variants failed, retrying each half separately: %s",
+            len(variant_payloads),
+            error,
         )
+        middle = len(variant_payloads) // 2
+        annotations = await request_vep_data(client, variant_payloads[:middle], cache)
+        annotations.update(
+            await request_vep_data(client, variant_payloads[middle:], cache)
+        )
+        return annotations
 
-    return annotated_variants
+    # A successful response can still leave out variants, e.g. ones VEP could not parse
+    # Sending them again gives the same response, so they are logged like a variant whose own request failed
+    for variant_payload in variant_payloads:
+        if variant_payload not in annotations:
+            logger.warning(
+                "Could not annotate variant '%s' with the VEP API: no record in response",
+                variant_payload,
+            )
+
+    return annotations
+
+
+def variant_key(variant: Variant) -> tuple[str, int, str, str]:
+    """
+    Key that identifies a variant for the VEP API. Variants with the same key get the same annotation
+
+    Args:
+        variant (Variant): Variant to get the key for
+
+    Returns:
+        Tuple of (chrom, pos, ref, alt)
+    """
+    return (variant.chrom, variant.pos, variant.ref, variant.alt)
+
+
+def get_cached_annotation(
+    key: tuple[str, int, str, str],
+) -> tuple[str | None, str] | None:
+    """
+    Look up (gene, consequence) of a variant annotated in an earlier batch
+
+    Args:
+        key (tuple[str, int, str, str]): Key of the variant from variant_key
+
+    Returns:
+        Tuple of (gene, consequence), or None if the variant has not been annotated yet
+    """
+    annotation = _ANNOTATION_CACHE.get(key)
+    if annotation is not None:
+        # Mark as most recently used so it is evicted last
+        _ANNOTATION_CACHE.move_to_end(key)
+    return annotation
+
+
+def cache_annotation(
+    key: tuple[str, int, str, str], annotation: tuple[str | None, str]
+):
+    """
+    Store (gene, consequence) of a variant so later batches do not query the VEP API for it again
+    Once ANNOTATION_CACHE_SIZE entries are stored, the least recently used entry is evicted
+
+    Args:
+        key (tuple[str, int, str, str]): Key of the variant from variant_key
+        annotation (tuple[str | None, str]): (gene, consequence) of the variant
+    """
+    _ANNOTATION_CACHE[key] = annotation
+    if len(_ANNOTATION_CACHE) > ANNOTATION_CACHE_SIZE:
+        _ANNOTATION_CACHE.popitem(last=False)
 
 
 def ensure_tuple(value: tuple | int) -> tuple:
@@ -8,7 +8,25 @@ Description:
     For production code, provide way to override these via command line or environment variables
 """
 
+import os
+from pathlib import Path
+
 VEP_GRCH37_URL = "https://grch37.rest.ensembl.org/vep/homo_sapiens/region"
 VEP_HEADERS = {"Content-Type": "application/json", "Accept": "application/json"}
-# Format obtained from https://grch37.rest.ensembl.org/documentation/info/vep_region_post
-VEP_REGION_PAYLOAD = "{chrom} {pos} . {ref} {alt} . . ."
+# Seconds to wait on the VEP API before a request is considered failed and retried
+VEP_TIMEOUT = 30
+# Connection pool for the VEP API. Connections are kept alive and reused across batches, and with HTTP/2 many batches share one connection
+VEP_MAX_CONNECTIONS = 64
+VEP_MAX_KEEPALIVE_CONNECTIONS = 32
+# Validate every Variant and AnnotatedVariant on creation. Set STRICT_VALIDATE=0 to skip validation for trusted input
+STRICT_VALIDATE = os.environ.get("STRICT_VALIDATE", "1") != "0"
+# Max number of variant annotations kept in memory so repeated variants across batches are not sent to the VEP API again
+ANNOTATION_CACHE_SIZE = 100_000
+# Directory of the persistent cache of VEP annotations, shared between runs
+VEP_CACHE_DIR = Path(os.environ.get("VEP_CACHE_DIR", "~/.cache/vep")).expanduser()
+# Prefix of every cache key. Change it when the VEP release behind VEP_GRCH37_URL changes so stale annotations are not reused
+VEP_CACHE_VERSION = "grch37-v2"
+# Seconds before a cached VEP annotation expires (30 days)
+VEP_CACHE_EXPIRE = 30 * 86400
+# Number of VCF records read and converted to Variant instances together
+VCF_CHUNK_SIZE = 4096
@@ -4,14 +4,21 @@ Author: Utsab Ray
 Created: 2025-11-17
 
 Description:
-    Module with definitions of Pydantic models for Variant and AnnotatedVariant
+    Module with definitions of dataclasses for Variant and AnnotatedVariant
+    Validation runs in __post_init__ and can be switched off with the STRICT_VALIDATE environment variable
 """
 
-from pydantic import BaseModel, Field, model_validator
+import re
+from dataclasses import dataclass
 from typing import Literal
+from src.config import STRICT_VALIDATE
 
+VARIANT_TYPES = ("snp", "ins", "del", "complex", "mnp")
+ALLELE_PATTERN = re.compile(r"[ACGT]+")
 
-class Variant(BaseModel):
+
+@dataclass(slots=True)
+class Variant:
     """
     A variant record from a VCF file
 
@@ -28,37 +35,52 @@ class Variant(BaseModel):
     """
 
     chrom: str
-    pos: int = Field(gt=0)  # variant.POS
-    ref: str = Field(pattern=r"^[ACGT]+$")  # variant.REF
-    alt: str = Field(pattern=r"^[ACGT]+$")  # variant.ALT
-    depth: int = Field(ge=0)  # variant.INFO["DP"]
-    ref_reads: int = Field(ge=0)  # variant.INFO["RO"]
-    alt_reads: int = Field(ge=0)  # variant.INFO["AO"]
-    maf: float = Field(
-        ge=0.0, le=1.0
-    )  # min(variant.INFO["AF"], 1 - variant.INFO["AF"])
+    pos: int  # variant.POS
+    ref: str  # variant.REF
+    alt: str  # variant.ALT
+    depth: int  # variant.INFO["DP"]
+    ref_reads: int  # variant.INFO["RO"]
+    alt_reads: int  # variant.INFO["AO"]
+    maf: float  # min(variant.INFO["AF"], 1 - variant.INFO["AF"])
     type: Literal["snp", "ins", "del", "complex", "mnp"]  # variant.INFO["TYPE"]
 
-    @model_validator(mode="after")
-    def validate_alt_ref_equality(self):
-        """Validation function to ensure ALT allele is not equal to REF allele"""
+    def __post_init__(self):
+        """Validate fields on creation unless STRICT_VALIDATE is switched off"""
+        if STRICT_VALIDATE:
+            self.validate()
+
+    def validate(self):
+        """
+        Ensure fields are within their allowed ranges, ALT allele is not equal to REF allele
+        and ref_reads + alt_reads does not exceed depth
+
+        Raises:
+            ValueError if any field is invalid
+        """
+        if self.pos <= 0:
+            raise ValueError(f"pos ({self.pos}) must be greater than 0")
+        if not ALLELE_PATTERN.fullmatch(self.ref):
+            raise ValueError(f"REF allele ({self.ref}) must only contain A, C, G, T")
+        if not ALLELE_PATTERN.fullmatch(self.alt):
+            raise ValueError(f"ALT allele ({self.alt}) must only contain A, C, G, T")
+        if self.depth < 0 or self.ref_reads < 0 or self.alt_reads < 0:
+            raise ValueError("depth, ref_reads and alt_reads cannot be negative")
+        if not 0.0 <= self.maf <= 1.0:
+            raise ValueError(f"maf ({self.maf}) must be between 0 and 1")
+        if self.type not in VARIANT_TYPES:
+            raise ValueError(f"type ({self.type}) must be one of {VARIANT_TYPES}")
+
         if self.alt == self.ref:
             raise ValueError("ALT allele cannot equal REF allele")
 
-        return self
-
-    @model_validator(mode="after")
-    def validate_read_depths(self):
-        """Ensure ref_reads + alt_reads does not exceed depth"""
         if self.ref_reads + self.alt_reads > self.depth:
             raise ValueError(
                 f"ref_reads ({self.ref_reads}) + alt_reads ({self.alt_reads}) = "
                 f"{self.ref_reads + self.alt_reads} exceeds depth ({self.depth})"
             )
 
-        return self
-
 
+@dataclass(slots=True)
 class AnnotatedVariant(Variant):
     """
     A fully annotated variant produced from Variant and VEP annotations
@@ -71,8 +93,61 @@ class AnnotatedVariant(Variant):
         consequence (str): Consequence of the variant
     """
 
-    alt_perc: float = Field(
-        ge=0.0, le=100.0
-    )  # (alt_reads / (alt_reads + ref_reads)) * 100
+    alt_perc: float  # (alt_reads / (alt_reads + ref_reads)) * 100
     gene: str | None = None  # Obtained from VEP API
     consequence: str | None = None  # Obtained from VEP API
+
+    @classmethod
+    def from_variant(
+        cls,
+        variant: Variant,
+        *,
+        alt_perc: float,
+        gene: str | None = None,
+        consequence: str | None = None,
+    ) -> "AnnotatedVariant":
+        """
+        Create an AnnotatedVariant from an existing Variant by copying its slots directly, without building a dict of its fields
+        Fields of @variant were validated when it was created, so only the annotation is validated here
+
+        Args:
+            variant (Variant): Variant that was annotated
+            alt_perc (float): Percentage of reads supporting the alternate allele (0.0 to 100.0)
+            gene (str | None): Gene affected by the variant
+            consequence (str | None): Consequence of the variant
+
+        Returns:
+            AnnotatedVariant with all fields of @variant plus the annotation
+        """
+        annotated_variant = cls.__new__(cls)
+        for name in Variant.__slots__:
+            setattr(annotated_variant, name, getattr(variant, name))
+        annotated_variant.alt_perc = alt_perc
+        annotated_variant.gene = gene
+        annotated_variant.consequence = consequence
+
+        if STRICT_VALIDATE:
+            annotated_variant.validate_annotation()
+
+        return annotated_variant
+
+    def validate(self):
+        """
+        Run all validation from Variant and validate_annotation
+
+        Raises:
+            ValueError if any field is invalid
+        """
+        # Zero argument super() does not work on dataclasses with slots=True
+        Variant.validate(self)
+        self.validate_annotation()
+
+    def validate_annotation(self):
+        """
+        Ensure alt_perc is a percentage
+
+        Raises:
+            ValueError if alt_perc is invalid
+        """
+        if not 0.0 <= self.alt_perc <= 100.0:
+            raise ValueError(f"alt_perc ({self.alt_perc}) must be between 0 and 100")
@@ -7,14 +7,64 @@ Description:
     Helper functions to interact with Ensembl VEP REST API and parse data retrieved from the API
 """
 
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Iterable
+import orjson
 from tenacity import (
+    RetryCallState,
+    RetryError,
     retry,
     stop_after_attempt,
     wait_random_exponential,
-    retry_if_exception_type,
+    retry_if_exception,
+    retry_if_result,
 )
-import requests
-from src.config import VEP_GRCH37_URL, VEP_HEADERS
+import httpx
+from diskcache import Cache
+from src.models import Variant
+from src.config import (
+    VEP_GRCH37_URL,
+    VEP_HEADERS,
+    VEP_TIMEOUT,
+    VEP_MAX_CONNECTIONS,
+    VEP_MAX_KEEPALIVE_CONNECTIONS,
+    VEP_CACHE_VERSION,
+    VEP_CACHE_EXPIRE,
+)
+
+
+def create_vep_client() -> httpx.AsyncClient:
+    """
+    Create the client used for all requests to the VEP REST API
+    The client is meant to be created once and shared by all batches, so the TCP/TLS handshake is only paid when a new connection is opened
+
+    Returns:
+        httpx.AsyncClient with HTTP/2 enabled and a keep-alive connection pool
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=VEP_MAX_CONNECTIONS,
+            max_keepalive_connections=VEP_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+        timeout=VEP_TIMEOUT,
+    )
+
+
+def variant_to_vep_region(variant: Variant) -> str:
+    """
+    Build the string that represents a variant in a request to the VEP API
+    Format obtained from https://grch37.rest.ensembl.org/documentation/info/vep_region_post
+
+    Args:
+        variant (Variant): Variant to query the API with
+
+    Returns:
+        String of the form "chrom pos . ref alt . . ."
+    """
+    return f"{variant.chrom} {variant.pos} . {variant.ref} {variant.alt} . . ."
 
 
 def get_genes_for_most_severe_consequence(vep_record: dict) -> str | None:
@@ -29,36 +79,272 @@ def get_genes_for_most_severe_consequence(vep_record: dict) -> str | None:
         Or None if "transcript_consequences" key is not present in @vep_record
     """
     most_severe = vep_record["most_severe_consequence"]
-    for transcript in vep_record.get("transcript_consequences", []):
-        cons_terms = transcript["consequence_terms"]
-        if most_severe in cons_terms:
-            return transcript["gene_id"]
+    # next stops at the first matching transcript. consequence_terms only holds a few terms, so scanning the list is cheaper than building a set per transcript
+    return next(
+        (
+            transcript["gene_id"]
+            for transcript in vep_record.get("transcript_consequences", ())
+            if most_severe in transcript["consequence_terms"]
+        ),
+        None,
+    )
+
+
+# Exceptions make_vep_request raises once all retries are exhausted
+# RetryError is raised when the last attempt returned None instead of raising
+VEP_REQUEST_ERRORS = (httpx.HTTPError, orjson.JSONDecodeError, RetryError)
+
+
+def is_retryable_error(exception: BaseException) -> bool:
+    """
+    Decide whether a failed request to the VEP REST API is worth retrying
+
+    Args:
+        exception (BaseException): Exception raised by an attempt of make_vep_request
+
+    Returns:
+        True for network failures, invalid JSON, rate limiting (429) and server errors (5xx)
+        False for other bad status codes, since sending the same payload again gives the same response
+    """
+    if isinstance(exception, httpx.HTTPStatusError):
+        status_code = exception.response.status_code
+        return status_code == 429 or status_code >= 500
+    return isinstance(exception, (httpx.TransportError, orjson.JSONDecodeError))
+
+
+def is_payload_error(exception: BaseException) -> bool:
+    """
+    Decide whether a request to the VEP REST API failed because of the variants in it, so that smaller requests may succeed
+
+    Args:
+        exception (BaseException): Exception raised by make_vep_request once all retries are exhausted
+
+    Returns:
+        True when the API rejected the payload (400, 413, 422) or took too long to answer it (read timeout)
+        False for outages, rate limiting and server errors, which splitting the request does not fix
+    """
+    if isinstance(exception, httpx.HTTPStatusError):
+        return exception.response.status_code in (400, 413, 422)
+    return isinstance(exception, httpx.ReadTimeout)
+
+
+def get_retry_after(exception: BaseException | None) -> float | None:
+    """
+    Get the number of seconds the VEP REST API asked to wait before the next request
+
+    Args:
+        exception (BaseException | None): Exception raised by an attempt of make_vep_request
+
+    Returns:
+        Seconds from the Retry-After header of a 429 response
+        None if @exception is not a 429 or the header is missing or cannot be parsed
+    """
+    if not (
+        isinstance(exception, httpx.HTTPStatusError)
+        and exception.response.status_code == 429
+    ):
+        return None
+
+    retry_after = exception.response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+
+    # Retry-After is either a number of seconds or an HTTP date
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+# Backoff between attempts when the VEP REST API did not say how long to wait
+_wait_exponential = wait_random_exponential(multiplier=1, max=60)
+
+
+def wait_for_vep(retry_state: RetryCallState) -> float:
+    """
+    Seconds tenacity waits before the next attempt of make_vep_request
+    A rate limited request waits as long as the Retry-After header asks, since retrying earlier is only rejected again
+
+    Args:
+        retry_state (RetryCallState): State of the call being retried
+
+    Returns:
+        Seconds from get_retry_after, or exponential backoff with jitter capped at 60 seconds
+    """
+    outcome = retry_state.outcome
+    exception = outcome.exception() if outcome is not None and outcome.failed else None
+    retry_after = get_retry_after(exception)
+    if retry_after is not None:
+        return retry_after
+    return _wait_exponential(retry_state)
 
 
 @retry(
     stop=stop_after_attempt(3),
-    wait=wait_random_exponential(multiplier=1, max=60),
-    retry=retry_if_exception_type(requests.exceptions.RequestException)
-    | retry_if_exception_type(requests.exceptions.HTTPError)
-    | retry_if_exception_type(requests.exceptions.ConnectionError)
-    | retry_if_exception_type(requests.exceptions.JSONDecodeError),
-    reraise=False,
+    wait=wait_for_vep,
+    retry=retry_if_exception(is_retryable_error)
+    | retry_if_result(lambda result: result is None),
+    reraise=True,
 )
-def make_vep_request(payload: dict) -> dict:
+async def make_vep_request(client: httpx.AsyncClient, payload: dict) -> list[dict]:
     """
     Calls the VEP REST API and retrieves annotation data for a batch of variants
-    Implement retries using tenacity. Retry strategy is exponential backoff with a max wait time of 60 seconds. After 3 failed attempts, give up and return None
+    Implement retries using tenacity. Retry strategy is exponential backoff with a max wait time of 60 seconds, or the Retry-After of a 429 response. After 3 failed attempts, give up and raise one of VEP_REQUEST_ERRORS
     https://github.com/jd/tenacity?tab=readme-ov-file#waiting-before-retrying
 
     Args:
+        client (httpx.AsyncClient): Client shared by all batches so connections to the API are reused
         payload (dict): Payload to send to the VEP REST API. Contains batch of variants to be annotated
 
     Returns:
         JSON response from the VEP REST API
     """
-    response = requests.post(
-        VEP_GRCH37_URL, json=payload, headers=VEP_HEADERS, timeout=10
+    # orjson encodes and decodes much faster than the json module httpx uses by default
+    # VEP_HEADERS sets the Content-Type, since httpx only adds it when using json=
+    response = await client.post(
+        VEP_GRCH37_URL, content=orjson.dumps(payload), headers=VEP_HEADERS
     )
     # If an exception is thrown here, tenacity will catch it and retry based on the strategy defined above
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
+
+
+async def make_cached_vep_request(
+    client: httpx.AsyncClient, payload: dict, cache: Cache | None = None
+) -> dict[str, tuple[str | None, str]]:
+    """
+    Annotate a batch of variants with the VEP REST API, looking them up in a persistent cache first
+    Only variants missing from @cache are sent to the VEP REST API, and their annotations are then added to @cache
+    Reading and writing @cache is blocking SQLite I/O, so it runs in a worker thread to keep the event loop free for other batches
+
+    Args:
+        client (httpx.AsyncClient): Client shared by all batches so connections to the API are reused
+        payload (dict): Payload to send to the VEP REST API. Contains batch of variants to be annotated
+        cache (Cache | None): Persistent cache of annotations keyed by variant payload string. If None, always call the API
+
+    Returns:
+        Dictionary of variant payload string to (gene, consequence) from parse_vep_record
+        Variants the VEP REST API returned no record for, e.g. when it could not parse the variant, are left out
+    """
+    variants = payload["variants"]
+
+    if cache is None:
+        return parse_vep_records(await make_vep_request(client, payload))
+
+    annotations = await asyncio.to_thread(read_cached_annotations, cache, variants)
+
+    missing = [variant for variant in variants if variant not in annotations]
+    if missing:
+        new_annotations = parse_vep_records(
+            await make_vep_request(client, {"variants": missing})
+        )
+        # Only annotations that came back for this exact variant are cached, so a variant VEP skipped is asked for again next time
+        await asyncio.to_thread(write_cached_annotations, cache, new_annotations)
+        annotations.update(new_annotations)
+
+    return annotations
+
+
+def parse_vep_records(vep_data_batch: list[dict]) -> dict[str, tuple[str | None, str]]:
+    """
+    Get the annotation of every variant in a response of the VEP REST API
+
+    Args:
+        vep_data_batch (list[dict]): JSON response from the VEP REST API
+
+    Returns:
+        Dictionary of variant payload string to (gene, consequence) from parse_vep_record
+    """
+    return {
+        variant: parse_vep_record(vep_data)
+        for variant, vep_data in index_vep_records(vep_data_batch).items()
+    }
+
+
+def parse_vep_record(vep_data: dict) -> tuple[str | None, str]:
+    """
+    Get the fields of a VEP record that go into the annotated csv
+
+    Args:
+        vep_data (dict): Single VEP JSON record for a variant
+
+    Returns:
+        Tuple of (gene, consequence)
+    """
+    return (
+        get_genes_for_most_severe_consequence(vep_data),
+        vep_data["most_severe_consequence"],
+    )
+
+
+def read_cached_annotations(
+    cache: Cache, variants: list[str]
+) -> dict[str, tuple[str | None, str]]:
+    """
+    Look up annotations of variants in the persistent cache. Blocking, run in a worker thread
+
+    Args:
+        cache (Cache): Persistent cache of annotations
+        variants (list[str]): Variant payload strings to look up
+
+    Returns:
+        Dictionary of variant payload string to (gene, consequence) for the variants found in @cache
+    """
+    annotations = {}
+    for variant in variants:
+        annotation = cache.get(vep_cache_key(variant))
+        if annotation is not None:
+            annotations[variant] = annotation
+    return annotations
+
+
+def write_cached_annotations(
+    cache: Cache, annotations: dict[str, tuple[str | None, str]]
+):
+    """
+    Store annotations of variants in the persistent cache. Blocking, run in a worker thread
+
+    Args:
+        cache (Cache): Persistent cache of annotations
+        annotations (dict[str, tuple[str | None, str]]): Variant payload string to (gene, consequence)
+    """
+    # Single transaction so all annotations of the batch are written to disk at once
+    with cache.transact():
+        for variant, annotation in annotations.items():
+            cache.set(vep_cache_key(variant), annotation, expire=VEP_CACHE_EXPIRE)
+
+
+def index_vep_records(vep_data_batch: Iterable[dict]) -> dict[str, dict]:
+    """
+    Match VEP records to the variants they annotate
+    VEP can return fewer records than variants it was sent, so records cannot be matched by position
+
+    Args:
+        vep_data_batch (Iterable[dict]): Records from the VEP REST API
+
+    Returns:
+        Dictionary of the variant payload string VEP echoes back in "input" to its record
+    """
+    return {
+        vep_data["input"]: vep_data
+        for vep_data in vep_data_batch
+        if vep_data.get("input") is not None
+    }
+
+
+def vep_cache_key(variant_payload: str) -> str:
+    """
+    Key of a variant in the persistent cache of VEP records
+
+    Args:
+        variant_payload (str): String for a single variant sent to the VEP API
+
+    Returns:
+        @variant_payload prefixed with the cache version so responses from an older VEP release are not reused
+    """
+    return f"{VEP_CACHE_VERSION}:{variant_payload}"
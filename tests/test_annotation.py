@@ -0,0 +1,108 @@
+"""
+Author: Utsab Ray
+
+Created: 2026-10-14
+
+Description:
+    Tests of how build_annotation handles failures of the VEP REST API, using httpx.MockTransport instead of the real API
+"""
+
+import asyncio
+import httpx
+import orjson
+import pytest
+import tenacity
+import src.annotation
+from src.annotation import build_annotation
+from src.models import Variant
+from src.vep import make_vep_request, wait_for_vep
+
+# Variant the mock VEP API rejects with 400 Bad Request whenever it is part of a request
+POISON_PAYLOAD = "1 300 . A G . . ."
+
+
+@pytest.fixture(autouse=True)
+def no_retry_wait(monkeypatch):
+    """Retry failed requests immediately and start every test with an empty in-memory cache"""
+    monkeypatch.setattr(make_vep_request.retry, "wait", tenacity.wait_none())
+    src.annotation._ANNOTATION_CACHE.clear()
+
+
+def make_variants(count: int) -> list[Variant]:
+    """SNPs at positions 100, 200, ... on chromosome 1"""
+    return [
+        Variant("1", 100 * (idx + 1), "A", "G", 20, 10, 10, 0.5, "snp")
+        for idx in range(count)
+    ]
+
+
+def vep_record(variant_payload: str) -> dict:
+    """Minimal VEP record for a variant, with gene ENSG<pos>"""
+    pos = variant_payload.split(" ")[1]
+    return {
+        "input": variant_payload,
+        "most_severe_consequence": "missense_variant",
+        "transcript_consequences": [
+            {"gene_id": f"ENSG{pos}", "consequence_terms": ["missense_variant"]}
+        ],
+    }
+
+
+def annotate(handler, variants: list[Variant]):
+    """Run build_annotation against a mock VEP API that answers every request with @handler"""
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await build_annotation(client, variants)
+
+    return asyncio.run(run())
+
+
+def test_outage_aborts_without_splitting_the_batch():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        raise httpx.ConnectError("connection refused", request=request)
+
+    with pytest.raises(httpx.ConnectError):
+        annotate(handler, make_variants(8))
+
+    # One request per attempt of the whole batch, no smaller requests
+    assert len(requests) == 3
+    assert all(len(orjson.loads(r.content)["variants"]) == 8 for r in requests)
+
+
+def test_poison_variant_only_fails_itself():
+    def handler(request):
+        variant_payloads = orjson.loads(request.content)["variants"]
+        if POISON_PAYLOAD in variant_payloads:
+            return httpx.Response(400)
+        return httpx.Response(200, json=[vep_record(v) for v in variant_payloads])
+
+    annotated_variants = annotate(handler, make_variants(8))
+
+    assert [v.pos for v in annotated_variants] == [100 * (idx + 1) for idx in range(8)]
+    for annotated_variant in annotated_variants:
+        if annotated_variant.pos == 300:
+            assert annotated_variant.gene is None
+            assert annotated_variant.consequence is None
+        else:
+            assert annotated_variant.gene == f"ENSG{annotated_variant.pos}"
+            assert annotated_variant.consequence == "missense_variant"
+
+
+def test_rate_limit_waits_for_retry_after_without_splitting():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(429, headers={"Retry-After": "7"})
+
+    with pytest.raises(httpx.HTTPStatusError) as error:
+        annotate(handler, make_variants(8))
+
+    assert len(requests) == 3
+    retry_state = tenacity.RetryCallState(None, None, (), {})
+    retry_state.set_exception((type(error.value), error.value, None))
+    assert wait_for_vep(retry_state) == 7.0
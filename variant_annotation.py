@@ -13,19 +13,44 @@ Usage:
 Args:
     --vcf: Path to input VCF file (default: challenge_data.vcf)
     --output: Path to output CSV file with annotated variants (default: annotated_variants.csv)
-    --threads: Number of threads for parallel processing (default: 8, max: 32)
+    --threads: Number of batches annotated concurrently (default: 8, max: 32)
     --batch_size: Number of variants to process in each batch, relevant for querying Ensembl VEP API (default: 100)
+    --no_cache: Do not read or write the persistent cache of VEP annotations in VEP_CACHE_DIR (default: ~/.cache/vep)
 
 Note:
     Writes CSV file with annotated variants
+    Exits with status 1 if the VEP API cannot be reached, in which case the CSV is incomplete
 """
 
 import argparse
+import asyncio
+import logging
+import os
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 import csv
-from concurrent.futures import ThreadPoolExecutor, Future
+import io
+from dataclasses import fields
+from itertools import islice
+from operator import attrgetter
+from typing import BinaryIO, Generator, Iterator
+from diskcache import Cache
 from src.annotation import read_vcf, build_annotation
-from src.models import AnnotatedVariant
+from src.config import VEP_CACHE_DIR
+from src.vep import VEP_REQUEST_ERRORS, create_vep_client
+from src.models import AnnotatedVariant, Variant
+
+logger = logging.getLogger(__name__)
+
+# Get field names from the dataclass so we can write the header before getting an instance of it
+FIELDNAMES = [field.name for field in fields(AnnotatedVariant)]
+# Builds the row for an AnnotatedVariant as a tuple in FIELDNAMES order, used when a row needs csv quoting
+get_row = attrgetter(*FIELDNAMES)
+# csv.writer ends lines with \r\n by default, kept so the output is the same as before
+LINE_TERMINATOR = "\r\n"
 
 
 def main():
@@ -46,7 +71,7 @@ def main():
         "--threads",
         type=int,
         default=8,
-        help="Number of threads for parallel processing (max 32)",
+        help="Number of batches annotated concurrently (max 32)",
         choices=range(1, 33),
     )
     parser.add_argument(
@@ -55,79 +80,225 @@ def main():
         default=100,
         help="Number of variants to process in each batch",
     )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Do not read or write the persistent cache of VEP annotations",
+    )
 
     args = parser.parse_args()
 
-    process(args.output, args.vcf, args.threads, args.batch_size)
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    try:
+        asyncio.run(
+            process(
+                args.output,
+                args.vcf,
+                args.threads,
+                args.batch_size,
+                use_cache=not args.no_cache,
+            )
+        )
+    except VEP_REQUEST_ERRORS as error:
+        # A batch failed for a reason other than its variants, e.g. the VEP API is down, so the rest of the VCF would fail too
+        logger.error(
+            "Aborting, VEP API request failed: %s. %s is incomplete", error, args.output
+        )
+        sys.exit(1)
 
 
-def process(output: Path, vcf: Path, threads: int, batch_size: int):
+async def process(
+    output: Path, vcf: Path, threads: int, batch_size: int, use_cache: bool = True
+):
     """
-    Driver function to iterate through VCF variants in batches using multiple threads and write the results to a CSV
+    Driver function to iterate through VCF variants in batches, annotate batches concurrently on an event loop and write the results to a CSV
+    The VCF is parsed and AnnotatedVariant instances are built in worker threads, so this CPU work overlaps with waiting on the VEP API
 
     Args:
         output (Path): Path to output CSV file with annotated variants
         vcf (Path): Path to input VCF file
-        threads (int): Number of threads for parallel processing
+        threads (int): Number of batches annotated concurrently
         batch_size (int): Number of variants to process in each batch
+        use_cache (bool): Reuse VEP annotations stored in VEP_CACHE_DIR by earlier runs, and store new ones there
     """
-    with open(output, "w") as csvfile:
-        # Get field names from the model so we can write the header before getting an instance of the model
-        fieldnames = list(AnnotatedVariant.model_fields.keys())
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+    with (
+        # Rows are formatted by format_row and written as bytes through a 1 MiB buffer
+        open(output, "wb", buffering=1 << 20) as csvfile,
+        Cache(VEP_CACHE_DIR) if use_cache else nullcontext() as cache,
+    ):
+        csvfile.write((",".join(FIELDNAMES) + LINE_TERMINATOR).encode())
+
+        # Worker threads for asyncio.to_thread, which parses the VCF and builds AnnotatedVariant instances off the event loop
+        # That work is CPU bound, so there is no point in more threads than CPUs
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=min(32, os.cpu_count() or 1))
+        )
+
+        # Batches parsed from the VCF that are waiting to be annotated
+        # Bounded so parsing only runs a few batches ahead of annotation
+        batch_queue = asyncio.Queue(maxsize=2 * threads)
+        # Parse the VCF while batches parsed earlier are waiting on the VEP API
+        producer = asyncio.create_task(produce_batches(vcf, batch_size, batch_queue))
+
+        # Create client once and reuse its connection pool for all batches
+        async with create_vep_client() as client:
+            # Each task annotates a single batch on the event loop
+            # Tasks are in submission order, so the oldest task is always on the left
+            tasks = deque()
+
+            try:
+                # None marks that the producer has no more batches
+                while (batch := await batch_queue.get()) is not None:
+                    # Order in which @task is inserted is order in which results are retrieved and written
+                    tasks.append(
+                        asyncio.create_task(build_annotation(client, batch, cache))
+                    )
+
+                    # Sliding window of args.threads tasks: as soon as the oldest task finishes, write it and start the next batch
+                    # The other tasks keep running in the meantime, so there is no stall waiting for a whole group of tasks
+                    # This window is what caps the number of batches waiting on the VEP API at @threads
+                    if len(tasks) >= threads:
+                        await write_oldest_task(tasks, csvfile)
+
+                # Tasks still running after the last batch was started
+                while tasks:
+                    await write_oldest_task(tasks, csvfile)
 
-        # Create thread pool once and reuse for all batches
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            # Batch of variants with max length of list equal to args.batch_size
-            batch = []
-            # Each future represents an object to be called, where an individual thread is responsible for the called object and all of its computation
-            futures = []
+                # Raise any exception from parsing the VCF
+                await producer
+            finally:
+                # If a batch failed or the run was interrupted, stop the other batches and the producer
+                # and wait for them to finish before the client is closed, so none is left pending or uses a closed client
+                for task in (*tasks, producer):
+                    task.cancel()
+                # Make room for the None the producer puts on the queue on its way out, so it cannot block on a full queue
+                while not batch_queue.empty():
+                    batch_queue.get_nowait()
+                await asyncio.gather(*tasks, producer, return_exceptions=True)
 
-            for variant in read_vcf(vcf):
-                batch.append(variant)
 
-                # When args.batch_size number of variants stored in batch, send batch for processing
-                if len(batch) == batch_size:
-                    # Submit batch to a single thread for processing
-                    future = executor.submit(build_annotation, batch)
-                    # Order in which @future is inserted is order in which results are retrieved and written
-                    futures.append(future)
+async def produce_batches(vcf: Path, batch_size: int, batch_queue: asyncio.Queue):
+    """
+    Parse the VCF in a worker thread and put batches of variants on @batch_queue, so the event loop is free to wait on the VEP API in the meantime
 
-                    # Reset batch for future variants
-                    batch = []
+    Args:
+        vcf (Path): Path to input VCF file
+        batch_size (int): Number of variants in each batch
+        batch_queue (asyncio.Queue): Queue that batches are put on in VCF order. Ends with None once the VCF is exhausted
+    """
+    batches = batch_variants(read_vcf(vcf), batch_size)
+    try:
+        # Batches of the generator are parsed one at a time, never concurrently
+        while batch := await asyncio.to_thread(next, batches, None):
+            await batch_queue.put(batch)
+    finally:
+        # Always mark the end of the batches so the consumer does not wait forever if parsing fails
+        await batch_queue.put(None)
 
-                    # When we have created args.threads number of threads, wait for all threads to finish, write results, and then resume processing
-                    if len(futures) == threads:
-                        write_futures_in_order(futures, writer)
-                        futures = []
 
-            # Variants left at the end where the main for loop exited, but there were still unprocessed variants in @batch
-            if batch:
-                future = executor.submit(build_annotation, batch)
-                futures.append(future)
+def batch_variants(
+    variants: Iterator[Variant], batch_size: int
+) -> Generator[list[Variant], None, None]:
+    """
+    Group variants into batches
 
-            # This cannot be a part of the if condition above, since there might be unprocessed futures, even if @batch is empty
-            if futures:
-                write_futures_in_order(futures, writer)
+    Args:
+        variants (Iterator[Variant]): Variants in VCF order
+        batch_size (int): Max number of variants in each batch
+
+    Returns:
+        Yield one list of variants with length @batch_size. The last batch may be shorter
+    """
+    while batch := list(islice(variants, batch_size)):
+        yield batch
 
 
-def write_futures_in_order(futures: list[Future], writer: csv.DictWriter):
+async def write_oldest_task(tasks: deque[asyncio.Task], csvfile: BinaryIO):
     """
-    Wait for futures to complete and write results to @writer in submission order. This is a blocking function
+    Wait for the oldest task in @tasks to complete, remove it from @tasks and write its results to @csvfile
+    Always writing the oldest task keeps the csv in submission order
 
     Args:
-        futures (list[Future]): Single unit of work which is responsible for a batch of variants
-        writer (csv.DictWriter): Enable writing of AnnotatedVariant model instances to a csv
+        tasks (deque[asyncio.Task]): Tasks in submission order, each responsible for a batch of variants
+        csvfile (BinaryIO): Output csv opened in binary mode
+    """
+    # Suspends until this specific task completes, other tasks keep running in the meantime
+    annotated_variant_batch = await tasks.popleft()
+    # One write for the whole batch instead of one per field or per row
+    csvfile.write("".join(map(format_row, annotated_variant_batch)).encode())
 
-    Note:
-        Write all annotated variants processed by all threads in @futues
+
+def format_row(annotated_variant: AnnotatedVariant) -> str:
     """
-    for future in futures:
-        # Blocks until this specific future completes
-        annotated_variant_batch = future.result()
-        for annotated_variant in annotated_variant_batch:
-            writer.writerow(annotated_variant.model_dump())
+    Format an AnnotatedVariant as one line of the csv, without going through the csv module
+    Falls back to csv.writer if any value contains a character that needs quoting
+
+    Args:
+        annotated_variant (AnnotatedVariant): Annotated variant to write
+
+    Returns:
+        Line of the csv with columns in FIELDNAMES order, ending with LINE_TERMINATOR
+    """
+    v = annotated_variant
+    # Must list the same fields in the same order as FIELDNAMES, which check_format_row verifies on import
+    line = (
+        f"{v.chrom},{v.pos},{v.ref},{v.alt},{v.depth},{v.ref_reads},{v.alt_reads},"
+        f"{v.maf},{v.type},{v.alt_perc},"
+        f"{'' if v.gene is None else v.gene},"
+        f"{'' if v.consequence is None else v.consequence}"
+    )
+    # Extra commas, quotes or line breaks can only come from string values, which csv would quote
+    if (
+        line.count(",") != len(FIELDNAMES) - 1
+        or '"' in line
+        or "\n" in line
+        or "\r" in line
+    ):
+        return format_row_with_csv(annotated_variant)
+
+    return line + LINE_TERMINATOR
+
+
+def format_row_with_csv(annotated_variant: AnnotatedVariant) -> str:
+    """
+    Format an AnnotatedVariant as one line of the csv using csv.writer, which quotes values where needed
+
+    Args:
+        annotated_variant (AnnotatedVariant): Annotated variant to write
+
+    Returns:
+        Line of the csv with columns in FIELDNAMES order, ending with LINE_TERMINATOR
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator=LINE_TERMINATOR).writerow(
+        get_row(annotated_variant)
+    )
+    return buffer.getvalue()
+
+
+def check_format_row():
+    """
+    Ensure the hand written format_row lists the same fields in the same order as FIELDNAMES
+    Formats an AnnotatedVariant whose every field holds its own name, so a field added, removed or reordered in only one of them is caught
+
+    Raises:
+        RuntimeError if format_row and FIELDNAMES disagree
+    """
+    probe = AnnotatedVariant.__new__(AnnotatedVariant)
+    for name in FIELDNAMES:
+        setattr(probe, name, name)
+
+    line = format_row(probe)
+    expected = ",".join(FIELDNAMES) + LINE_TERMINATOR
+    if line != expected:
+        raise RuntimeError(
+            f"format_row writes {line!r}, but FIELDNAMES expects {expected!r}"
+        )
+
+
+# Checked on import so a mismatch fails straight away instead of writing a csv with misaligned columns
+check_format_row()
 
 
 if __name__ == "__main__":